@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 OpenIO SAS, as part of OpenIO SDS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark oio-container-ch-flush and oio-container-ch-du against a
+simulated SDS backend, living in the process.
+
+The tools run unmodified, only their ObjectStorageApi is replaced by
+FakeObjectStorageApi, which serves a synthetic bucket with the page size,
+the latency and the rate of election failures of the command line.
+"""
+
+from __future__ import print_function
+import argparse
+import bisect
+import os
+import random
+import sys
+import time
+import types
+try:
+    from importlib.machinery import SourceFileLoader
+    from importlib.util import module_from_spec, spec_from_loader
+except ImportError:  # Python 2
+    import imp
+    SourceFileLoader = None
+
+
+TOOLS = {
+    # name: (script, option setting the concurrency)
+    'flush': ('oio-container-ch-flush.py', '--max-worker'),
+    'du': ('oio-container-ch-du.py', '--concurrency'),
+}
+BUCKET = 'bench'
+OPERATIONS = ('container_list', 'object_list', 'object_delete_many',
+              'container_delete')
+# The operations served by meta2 services, which may fail on an election.
+# The account service listing the containers has none.
+ELECTED = ('object_list', 'object_delete_many', 'container_delete')
+
+
+class FakeBackend(object):
+    """
+    The state of the simulated namespace, and the behaviour of its
+    services: page size, latency and election failures.
+    """
+
+    def __init__(self, args):
+        self.page_size = args.page_size
+        self.latency = args.latency
+        self.sigma = args.latency_sigma
+        self.saturation = args.saturation
+        self.election_rate = args.election_rate
+        self.random = random.Random(args.seed)
+        self.containers = dict()
+        self.names = list()
+        self.inflight = 0
+        self.latencies = dict((op, []) for op in OPERATIONS)
+        self.objects_deleted = 0
+        self.containers_deleted = 0
+        self.elections = 0
+        self.first = None
+        self.last = None
+
+    def populate(self, containers, objects, depth, seed):
+        """Build a bucket of `containers` containers, over `depth` levels."""
+        rand = random.Random(seed)
+        self.containers.clear()
+        for i in range(containers):
+            path = [BUCKET]
+            for level in range(depth - 1):
+                path.append('d%d' % rand.randrange(10))
+            path.append('%08x%06d' % (rand.getrandbits(32), i))
+            self.containers['%2F'.join(path)] = dict(
+                ('obj/%08x' % rand.getrandbits(32), rand.randrange(1 << 20))
+                for _ in range(objects))
+        self.names = sorted(self.containers)
+
+    def call(self, op, func, *args, **kwargs):
+        """Run func as the operation `op` of a service."""
+        start = time.time()
+        if self.first is None:
+            self.first = start
+        self.inflight += 1
+        try:
+            delay = self.random.lognormvariate(0, self.sigma) * self.latency
+            if self.saturation and self.inflight > self.saturation:
+                # Queueing on the service side
+                delay *= float(self.inflight) / self.saturation
+            time.sleep(delay)
+            if op in ELECTED and self.random.random() < self.election_rate:
+                self.elections += 1
+                raise Exception("Election failed")
+            return func(*args, **kwargs)
+        finally:
+            self.inflight -= 1
+            self.last = time.time()
+            self.latencies[op].append(self.last - start)
+
+    def limit(self, limit):
+        if not limit:
+            return self.page_size
+        return min(limit, self.page_size)
+
+
+class FakeObjectStorageApi(object):
+    """The subset of ObjectStorageApi the tools use."""
+
+    backend = None
+
+    def __init__(self, namespace, **kwargs):
+        self.namespace = namespace
+
+    def container_list(self, account, limit=None, marker=None,
+                       end_marker=None, prefix=None, delimiter=None,
+                       **kwargs):
+        return self.backend.call(
+            'container_list', self._container_list, limit, marker,
+            end_marker, prefix)
+
+    def _container_list(self, limit, marker, end_marker, prefix):
+        names = self.backend.names
+        start = bisect.bisect_left(names, prefix or '')
+        if marker is not None:
+            start = max(start, bisect.bisect_right(names, marker))
+        objects = self.backend.containers
+        listing = list()
+        for name in names[start:start + self.backend.limit(limit)]:
+            if prefix and not name.startswith(prefix):
+                break
+            if end_marker is not None and name >= end_marker:
+                break
+            listing.append(
+                [name, len(objects[name]), sum(objects[name].values()), 0])
+        return listing
+
+    def object_list(self, account, container, limit=None, marker=None,
+                    prefix=None, **kwargs):
+        return self.backend.call(
+            'object_list', self._object_list, container, limit, marker,
+            prefix)
+
+    def _object_list(self, container, limit, marker, prefix):
+        objects = self.backend.containers.get(container)
+        if objects is None:
+            raise Exception("Container not found")
+        names = sorted(
+            name for name in objects
+            if (not prefix or name.startswith(prefix)) and
+            (marker is None or name > marker))
+        page = names[:self.backend.limit(limit)]
+        return {'objects': [{'name': name, 'size': objects[name]}
+                            for name in page],
+                'prefixes': [],
+                'truncated': len(page) < len(names),
+                'next_marker': page[-1] if page else None}
+
+    def object_delete_many(self, account, container, objs, **kwargs):
+        return self.backend.call(
+            'object_delete_many', self._object_delete_many, container, objs)
+
+    def _object_delete_many(self, container, objs):
+        objects = self.backend.containers.get(container)
+        if objects is None:
+            raise Exception("Container not found")
+        result = list()
+        for name in objs:
+            deleted = objects.pop(name, None) is not None
+            self.backend.objects_deleted += deleted
+            result.append((name, deleted))
+        return result
+
+    def container_delete(self, account, container, **kwargs):
+        return self.backend.call(
+            'container_delete', self._container_delete, container)
+
+    def _container_delete(self, container):
+        objects = self.backend.containers.get(container)
+        if objects is None:
+            raise Exception("Container not found")
+        if objects:
+            raise Exception("Container not empty")
+        del self.backend.containers[container]
+        names = self.backend.names
+        del names[bisect.bisect_left(names, container)]
+        self.backend.containers_deleted += 1
+
+
+def install_fake_oio():
+    """Let the tools be loaded on a host without the oio package."""
+    try:
+        import oio.api.object_storage  # noqa
+        return
+    except ImportError:
+        pass
+    for name in ('oio', 'oio.api', 'oio.api.object_storage'):
+        sys.modules.setdefault(name, types.ModuleType(name))
+    sys.modules['oio.api.object_storage'].ObjectStorageApi = \
+        FakeObjectStorageApi
+
+
+def load_source(name, path):
+    """Load a script as a module, whatever its extension."""
+    if SourceFileLoader is None:
+        return imp.load_source(name, path)
+    loader = SourceFileLoader(name, path)
+    module = module_from_spec(spec_from_loader(name, loader))
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def load_tool(name):
+    script = TOOLS[name][0]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    tool = load_source(script[:-3].replace('-', '_'), path)
+    tool.ObjectStorageApi = FakeObjectStorageApi
+    return tool
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def run(tool, name, args, workers):
+    """Run the main() of the tool over a fresh bucket, quietly."""
+    backend = FakeBackend(args)
+    backend.populate(args.containers, args.objects, args.depth, args.seed)
+    FakeObjectStorageApi.backend = backend
+    argv = [TOOLS[name][0]]
+    if name == 'flush':
+        argv += ['--timeout', '1', '--report', '3600']
+    if workers and TOOLS[name][1]:
+        argv += [TOOLS[name][1], str(workers)]
+    argv.append(BUCKET)
+    saved = sys.argv, sys.stdout
+    sys.argv = argv
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        tool.main()
+    finally:
+        sys.stdout.close()
+        sys.argv, sys.stdout = saved
+    return backend
+
+
+def report(name, args, workers, backend):
+    # The first and last calls to the backend bound the run, the tools
+    # may wait a bit before leaving
+    elapsed = (backend.last or 0.0) - (backend.first or 0.0)
+    elapsed = elapsed or 1e-9
+    latencies = sorted(sum(backend.latencies.values(), []))
+    if name == 'flush':
+        objects = backend.objects_deleted
+        containers = backend.containers_deleted
+    else:
+        objects = args.containers * args.objects
+        containers = args.containers
+    print("%8s %9.2f %12.1f %13.1f %8.1f %8.1f %8.1f %9d" % (
+          workers or '-', elapsed, objects / elapsed, containers / elapsed,
+          percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+          (latencies[-1] if latencies else 0.0) * 1000, backend.elections))
+    sys.stdout.flush()
+
+
+def options():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--containers', default=1000, type=int,
+                        help="Containers in the bucket")
+    parser.add_argument('--objects', default=100, type=int,
+                        help="Objects per container")
+    parser.add_argument('--depth', default=2, type=int,
+                        help="Levels of the container hierarchy")
+    parser.add_argument('--page-size', default=1000, type=int,
+                        help="Largest page returned by a listing")
+    parser.add_argument('--latency', default=0.005, type=float,
+                        help="Median latency of a request, in seconds")
+    parser.add_argument('--latency-sigma', default=0.5, type=float,
+                        help="Spread of the log-normal latency")
+    parser.add_argument('--saturation', default=32, type=int,
+                        help="Requests in flight beyond which the latency "
+                             "grows linearly (0 for no limit)")
+    parser.add_argument('--election-rate', default=0.0, type=float,
+                        help="Ratio of the meta2 requests failing with "
+                             "'Election failed'")
+    parser.add_argument('--workers', default='10,20,50,100',
+                        type=lambda x: [int(w) for w in x.split(',')],
+                        help="Comma-separated concurrency settings "
+                             "(default: %(default)s)")
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('tool', choices=sorted(TOOLS),
+                        help="The tool to benchmark")
+    return parser.parse_args()
+
+
+def main():
+    args = options()
+    install_fake_oio()
+    tool = load_tool(args.tool)
+    workers = args.workers if TOOLS[args.tool][1] else [None]
+    print("%8s %9s %12s %13s %8s %8s %8s %9s" % (
+          "workers", "seconds", "objects/s", "containers/s", "p50 ms",
+          "p99 ms", "max ms", "elections"))
+    for count in workers:
+        backend = run(tool, args.tool, args, count)
+        report(args.tool, args, count, backend)
+
+
+if __name__ == '__main__':
+    main()
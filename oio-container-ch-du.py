@@ -16,14 +16,37 @@
 
 from __future__ import print_function
 import argparse
+import heapq
 import math
 import os
+import sqlite3
+import sys
+import time
+import eventlet
+from eventlet import Queue
 
 from oio.api.object_storage import ObjectStorageApi
 
+eventlet.monkey_patch()
 
 ACCOUNT = None
 PROXY = None
+# Listing pages buffered per concurrent listing, and characters of the
+# names explored to split the keyspace into ranges
+RANGE_PAGES = 4
+SPLIT_DEPTH = 32
+# Objects per page of the object listings
+OBJECT_PAGE = 1000
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
 
 
 def container_hierarchy(bucket, path):
@@ -33,29 +56,324 @@ def container_hierarchy(bucket, path):
     return bucket + '%2F' + ch
 
 
-def get_list(bucket):
-    items = PROXY.object_list(ACCOUNT, bucket)
+class Node(object):
+    __slots__ = ('files', 'size', 'children')
+
+    def __init__(self):
+        self.files = 0
+        self.size = 0
+        self.children = None
+
+
+class Aggregator(object):
+    """
+    Prefix tree of the container hierarchy, fed with one container at a
+    time. Each node holds the objects and bytes of its subtree, and each
+    path component is stored once, in its parent. Below `max_depth`, the
+    containers are accounted to their ancestor at `max_depth`.
+    """
+
+    def __init__(self, root, max_depth=None):
+        self.name = root
+        self.root = Node()
+        self.max_depth = max_depth
+
+    def add(self, components, files, size):
+        node = self.root
+        node.files += files
+        node.size += size
+        for depth, component in enumerate(components, 1):
+            if self.max_depth is not None and depth > self.max_depth:
+                break
+            if node.children is None:
+                node.children = dict()
+            child = node.children.get(component)
+            if child is None:
+                child = node.children[component] = Node()
+            child.files += files
+            child.size += size
+            node = child
+
+    def walk(self):
+        """Yield (size, files, path) for each node, depth first."""
+        stack = [(self.name, self.root)]
+        while stack:
+            path, node = stack.pop()
+            yield node.size, node.files, path
+            if node.children:
+                for component, child in node.children.items():
+                    stack.append((path + '/' + component, child))
+
+    def top(self, count):
+        """The `count` largest nodes, smallest first."""
+        return sorted(heapq.nlargest(count, self.walk()))
+
+
+class Snapshot(object):
+    """
+    Local store of the (objects, bytes, mtime) of each container, and of
+    the totals of each path of the hierarchy. A refresh only touches the
+    containers whose listing entry changed, and applies their difference
+    to the totals of their ancestors. The paths are '/'-separated, as
+    printed by du.
+    """
+
+    def __init__(self, path, readonly=False):
+        if readonly:
+            # Connecting would create a missing file, and the schema
+            try:
+                self.conn = sqlite3.connect(
+                    'file:%s?mode=ro' % pathname2url(os.path.abspath(path)),
+                    uri=True)
+            except TypeError:
+                # No URI filenames before Python 3.4
+                self.conn = sqlite3.connect(path)
+            return
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS containers (
+                name TEXT PRIMARY KEY NOT NULL,
+                files INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL);
+            CREATE TABLE IF NOT EXISTS paths (
+                path TEXT PRIMARY KEY NOT NULL,
+                depth INTEGER NOT NULL,
+                containers INTEGER NOT NULL,
+                files INTEGER NOT NULL,
+                size INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS paths_depth ON paths(depth, path);
+            CREATE TABLE IF NOT EXISTS refreshes (
+                prefix TEXT PRIMARY KEY NOT NULL,
+                refreshed REAL NOT NULL);
+        """)
+
+    @staticmethod
+    def ancestors(name):
+        items = name.split('%2F')
+        for i in range(1, len(items) + 1):
+            yield '/'.join(items[:i])
+
+    def refresh(self, prefix, listing):
+        """
+        Reconcile the containers named `prefix` or below with `listing`.
+        Return the containers changed, added and removed.
+        """
+        known = dict(
+            (row[0], row[1:]) for row in self.conn.execute(
+                "SELECT name, files, size, mtime FROM containers "
+                "WHERE name = ? OR (name >= ? AND name < ?)",
+                (prefix, prefix + '%2F', prefix + '%2G')))
+        deltas = dict()
+        updates = list()
+        changed = added = 0
+
+        def account(name, containers, files, size):
+            for path in self.ancestors(name):
+                delta = deltas.setdefault(path, [0, 0, 0])
+                delta[0] += containers
+                delta[1] += files
+                delta[2] += size
+
+        for entry in listing:
+            name, files, size = entry[:3]
+            if name != prefix and not name.startswith(prefix + '%2F'):
+                continue
+            mtime = entry[4] if len(entry) > 4 else None
+            old = known.pop(name, None)
+            if old == (files, size, mtime):
+                continue
+            if old is None:
+                added += 1
+                account(name, 1, files, size)
+            else:
+                changed += 1
+                account(name, 0, files - old[0], size - old[1])
+            updates.append((name, files, size, mtime))
+        for name, old in known.items():
+            account(name, -1, -old[0], -old[1])
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO containers VALUES (?, ?, ?, ?)",
+                updates)
+            self.conn.executemany(
+                "DELETE FROM containers WHERE name = ?",
+                ((name, ) for name in known))
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO paths VALUES (?, ?, 0, 0, 0)",
+                ((path, path.count('/')) for path in deltas))
+            self.conn.executemany(
+                "UPDATE paths SET containers = containers + ?, "
+                "files = files + ?, size = size + ? WHERE path = ?",
+                (tuple(delta) + (path, ) for path, delta in deltas.items()))
+            self.conn.execute("DELETE FROM paths WHERE containers <= 0")
+            self.conn.execute(
+                "INSERT OR REPLACE INTO refreshes VALUES (?, ?)",
+                (prefix, time.time()))
+        return changed, added, len(known)
+
+    def query(self, path, max_depth=None):
+        """Yield (size, files, path) for `path` and the paths below it."""
+        if max_depth is None:
+            rows = self.conn.execute(
+                "SELECT path, files, size FROM paths "
+                "WHERE path = ? OR (path >= ? AND path < ?)",
+                (path, path + '/', path + '0'))
+        else:
+            # One range of the index per level
+            depth = path.count('/')
+            rows = self.conn.execute(
+                "SELECT path, files, size FROM paths "
+                "WHERE depth IN (%s) AND (path = ? OR "
+                "(path >= ? AND path < ?))" % ','.join(
+                    str(depth + i) for i in range(max_depth + 1)),
+                (path, path + '/', path + '0'))
+        for name, files, size in rows:
+            yield size, files, name
+
+    def diff(self, other, path, max_depth=None):
+        """
+        Yield (size growth, files growth, path) from the snapshot in the
+        file `other` to this one, for the paths that changed.
+        """
+        old = Snapshot(other, readonly=True)
+        try:
+            before = dict((name, (size, files)) for size, files, name
+                          in old.query(path, max_depth))
+        finally:
+            old.close()
+        for size, files, name in self.query(path, max_depth):
+            old_size, old_files = before.pop(name, (0, 0))
+            if (size, files) != (old_size, old_files):
+                yield size - old_size, files - old_files, name
+        for name, (size, files) in before.items():
+            yield -size, -files, name
+
+    def close(self):
+        self.conn.close()
+
+
+class ObjectStats(object):
+    """Distribution of the sizes of the objects, and the largest ones."""
+
+    def __init__(self, largest=10):
+        # Bucket i counts the sizes up to 2**i
+        self.buckets = dict()
+        self.largest = list()
+        self.count = largest
+
+    def add(self, container, entry):
+        size = entry['size']
+        power = (size - 1).bit_length() if size > 0 else 0
+        files, total = self.buckets.get(power, (0, 0))
+        self.buckets[power] = (files + 1, total + size)
+        if self.count:
+            item = (size, container, entry['name'])
+            if len(self.largest) < self.count:
+                heapq.heappush(self.largest, item)
+            elif item > self.largest[0]:
+                heapq.heapreplace(self.largest, item)
+
+
+def get_list(bucket, stats=None):
+    """
+    Count the objects of a container, page after page. Return the
+    objects, their size, and the containers of the "directory"
+    placeholders.
+    """
     todo = []
     _size = 0
     _files = 0
-    for entry in items['objects']:
-        if entry['name'].endswith('/'):
-            todo.append(container_hierarchy(bucket, entry['name']))
-        else:
-            _size += entry['size']
-            _files += 1
+    marker = None
+    while True:
+        items = PROXY.object_list(ACCOUNT, bucket, marker=marker,
+                                  limit=OBJECT_PAGE)
+        objects = items['objects']
+        for entry in objects:
+            if entry['name'].endswith('/'):
+                todo.append(container_hierarchy(bucket, entry['name']))
+            else:
+                _size += entry['size']
+                _files += 1
+                if stats is not None:
+                    stats.add(bucket, entry)
+        if not objects or \
+                not items.get('truncated', len(objects) >= OBJECT_PAGE):
+            break
+        marker = items.get('next_marker') or objects[-1]['name']
 
     return _files, _size, todo
 
 
+def walk_objects(root, concurrency, stats=None):
+    """
+    Yield (container, objects, size) for `root` and the containers
+    reached through its placeholders, listed `concurrency` at a time.
+    """
+    pool = eventlet.GreenPool(concurrency)
+    results = Queue()
+
+    def visit(name):
+        try:
+            results.put((name, get_list(name, stats)))
+        except Exception as exc:
+            results.put((name, exc))
+
+    pool.spawn_n(visit, root)
+    pending = 1
+    while pending:
+        name, result = results.get()
+        pending -= 1
+        if isinstance(result, Exception):
+            print("Objs %s: %s" % (name, result), file=sys.stderr)
+            continue
+        _files, _size, todo = result
+        yield name, _files, _size
+        for child in todo:
+            pool.spawn_n(visit, child)
+            pending += 1
+
+
 def options():
     parser = argparse.ArgumentParser()
     parser.add_argument("--account", default=os.getenv("OIO_ACCOUNT", "demo"))
     parser.add_argument("--namespace", default=os.getenv("OIO_NS", "OPENIO"))
     parser.add_argument("--human", "-H", action="store_true", default=False)
+    parser.add_argument("--max-depth", type=int,
+                        help="Only show the paths up to this depth below "
+                             "the path asked")
+    parser.add_argument("--top", type=int, default=0,
+                        help="Only show the N largest paths")
+    parser.add_argument("--concurrency", type=int, default=10,
+                        help="Ranges of containers listed in parallel")
+    parser.add_argument("--partitions", type=int, default=0,
+                        help="Ranges the keyspace is split into "
+                             "(default: 4 per concurrent listing)")
+    parser.add_argument("--objects", action="store_true", default=False,
+                        help="Count the objects themselves, walking the "
+                             "directory placeholders")
+    parser.add_argument("--largest", type=int, default=10,
+                        help="With --objects, show the N largest objects")
+    parser.add_argument("--snapshot",
+                        help="Keep the usage of the containers in this "
+                             "file, refresh it and answer from it")
+    parser.add_argument("--cached", action="store_true", default=False,
+                        help="Answer from the snapshot without "
+                             "refreshing it")
+    parser.add_argument("--diff", metavar="OLD_SNAPSHOT",
+                        help="Show the growth of each path since the "
+                             "OLD_SNAPSHOT file")
     parser.add_argument("path", help="bucket/path1/path2")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if (args.cached or args.diff) and not args.snapshot:
+        parser.error("--cached and --diff need a --snapshot")
+    if args.diff and not os.path.isfile(args.diff):
+        parser.error("--diff: no snapshot at %s" % args.diff)
+    if args.objects and args.snapshot:
+        parser.error("--objects does not work with --snapshot")
+    return args
 
 
 def show(size, human=False):
@@ -72,19 +390,189 @@ def show(size, human=False):
     return "%7s%s" % (s, size_name[i])
 
 
+def list_pages(**kwargs):
+    listing = PROXY.container_list(ACCOUNT, **kwargs)
+    while listing:
+        yield listing
+        kwargs['marker'] = listing[-1][0]
+        listing = PROXY.container_list(ACCOUNT, **kwargs)
+
+
 def full_list(**kwargs):
-        listing = PROXY.container_list(
-            ACCOUNT, **kwargs)
+    for listing in list_pages(**kwargs):
         for element in listing:
             yield element
 
-        while listing:
-            kwargs['marker'] = listing[-1][0]
-            listing = PROXY.container_list(
-                ACCOUNT, **kwargs)
-            if listing:
-                for element in listing:
-                    yield element
+
+def next_chars(prefix):
+    """
+    The characters following `prefix` in the names of the containers,
+    found by skipping over the names sharing each one, one request each.
+    """
+    chars = list()
+    kwargs = {'prefix': prefix, 'limit': 1}
+    while True:
+        probe = PROXY.container_list(ACCOUNT, **kwargs)
+        if not probe:
+            return chars
+        name = probe[0][0]
+        if name == prefix:
+            kwargs['marker'] = name
+            continue
+        char = name[len(prefix)]
+        chars.append(char)
+        kwargs['marker'] = prefix + unichr(ord(char) + 1)
+
+
+def split_points(prefix, partitions, depth=0):
+    """
+    Lower bounds of the ranges after the first one, at the characters
+    found after `prefix`. When there are fewer characters than
+    partitions, the names following each character are split in turn,
+    concurrently: the bounds follow the hierarchy actually present.
+    """
+    chars = next_chars(prefix)
+    if len(chars) >= partitions:
+        step = float(len(chars)) / partitions
+        return sorted(set(prefix + chars[int(i * step)]
+                          for i in range(1, partitions)))
+    points = [prefix + char for char in chars[1:]]
+    share = partitions // max(1, len(chars))
+    if share > 1 and depth < SPLIT_DEPTH:
+        pile = eventlet.GreenPile()
+        for char in chars:
+            pile.spawn(split_points, prefix + char, share, depth + 1)
+        for sub in pile:
+            points.extend(sub)
+    return sorted(set(points))
+
+
+def list_range(prefix, lower, upper, pages):
+    """
+    Put the pages of the containers from `lower` (included) to `upper`
+    (excluded) in `pages`, then None, or the exception that stopped it.
+    """
+    try:
+        kwargs = {'prefix': prefix}
+        if lower is not None:
+            # The marker is excluded from the listing
+            probe = PROXY.container_list(ACCOUNT, prefix=lower, limit=1)
+            if probe and probe[0][0] == lower:
+                pages.put(probe)
+            kwargs['marker'] = lower
+        if upper is not None:
+            kwargs['end_marker'] = upper
+        for listing in list_pages(**kwargs):
+            pages.put(listing)
+        pages.put(None)
+    except Exception as exc:
+        pages.put(exc)
+
+
+def parallel_list(prefix, partitions, concurrency):
+    """
+    Same containers as full_list(prefix=prefix), with the keyspace split
+    into `partitions` ranges listed by `concurrency` green threads. The
+    pages are yielded as they come, whatever their range: the sums do not
+    depend on the order, and waiting for the ranges in order would stall
+    on the slowest one.
+
+    The split points take sequential probes, so the head of the listing
+    is listed meanwhile: a listing done before them needs no split, and
+    otherwise the head stops at the first split point past its marker.
+    """
+    pages = Queue(concurrency * RANGE_PAGES)
+    pool = eventlet.GreenPool(concurrency)
+    head = {'marker': None, 'upper': None, 'running': 1}
+
+    def list_head():
+        try:
+            kwargs = {'prefix': prefix}
+            while True:
+                listing = PROXY.container_list(ACCOUNT, **kwargs)
+                upper = head['upper']
+                if upper is not None:
+                    kwargs['end_marker'] = upper
+                    listing = [e for e in listing if e[0] < upper]
+                if not listing:
+                    break
+                # Set before queueing, the ranges must start past it
+                kwargs['marker'] = head['marker'] = listing[-1][0]
+                pages.put(listing)
+            pages.put(None)
+        except Exception as exc:
+            pages.put(exc)
+
+    def spawn_ranges():
+        try:
+            points = split_points(prefix, partitions)
+        except Exception as exc:
+            pages.put(exc)
+            return
+        marker = head['marker']
+        bounds = [p for p in points if marker is None or p > marker]
+        if not bounds:
+            return
+        head['upper'] = bounds[0]
+        head['running'] += len(bounds)
+        for lower, upper in zip(bounds, bounds[1:] + [None]):
+            pool.spawn(list_range, prefix, lower, upper, pages)
+
+    pool.spawn(list_head)
+    spawner = eventlet.spawn(spawn_ranges)
+    try:
+        while head['running']:
+            listing = pages.get()
+            if listing is None:
+                head['running'] -= 1
+                continue
+            if isinstance(listing, Exception):
+                raise listing
+            for element in listing:
+                yield element
+    finally:
+        spawner.kill()
+        for thread in list(pool.coroutines_running):
+            thread.kill()
+
+
+def list_all(args, prefix):
+    if args.concurrency > 1:
+        return parallel_list(prefix, args.partitions or
+                             4 * args.concurrency, args.concurrency)
+    return full_list(prefix=prefix)
+
+
+def main_snapshot(args, prefix):
+    snapshot = Snapshot(args.snapshot)
+    try:
+        if not args.cached:
+            start = time.time()
+            changed, added, removed = snapshot.refresh(
+                prefix, list_all(args, prefix))
+            print("refreshed in %.2fs: %d changed, %d added, %d removed" % (
+                  time.time() - start, changed, added, removed))
+        if args.diff:
+            view = snapshot.diff(args.diff, args.path, args.max_depth)
+        else:
+            view = snapshot.query(args.path, args.max_depth)
+        if args.top:
+            view = sorted(heapq.nlargest(args.top, view))
+        else:
+            view = sorted(view)
+        for v, f, k in view:
+            if args.diff:
+                sign = '-' if v < 0 else '+'
+                print("%11s %+10d  %s" % (
+                      sign + show(abs(v), args.human).strip(), f, k))
+            else:
+                print("%s %10d  %s" % (show(v, args.human), f, k))
+        if not args.diff:
+            total = [(f, v) for v, f, k in snapshot.query(args.path, 0)]
+            files, size = total[0] if total else (0, 0)
+            print("found %d files, %s bytes" % (files, size))
+    finally:
+        snapshot.close()
 
 
 def main():
@@ -101,39 +589,47 @@ def main():
         bucket = args.path
         path = ""
 
-    items = [container_hierarchy(bucket, path)]
-    files = 0
-    size = 0
+    _bucket = container_hierarchy(bucket, path)
+    if args.snapshot:
+        return main_snapshot(args, _bucket)
 
-    SUM = {}
+    stats = None
+    if args.objects:
+        stats = ObjectStats(args.largest)
+        listing = walk_objects(_bucket, args.concurrency, stats)
+    else:
+        listing = list_all(args, _bucket)
+    tree = Aggregator(args.path, max_depth=args.max_depth)
+    for entry in listing:
+        name, _files, _size = entry[:3]
+        if name == _bucket:
+            tree.add((), _files, _size)
+        elif name.startswith(_bucket + '%2F'):
+            tree.add(name[len(_bucket) + 3:].split('%2F'), _files, _size)
 
-    files = 0
-    size = 0
-    _bucket = container_hierarchy(bucket, path)
-    for entry in full_list(prefix=container_hierarchy(bucket, path)):
-        name, _files, _size, _ = entry
-        if name != _bucket and not name.startswith(_bucket + '%2F'):
-            continue
-        size += _size
-        files += _files
+    if args.top:
+        view = tree.top(args.top)
+    else:
+        view = sorted(tree.walk())
+    for v, f, k in view:
+        print("%s %10d  %s" % (show(v, args.human), f, k))
 
-        items = name.split('%2F')
-        while items:
-            _name = '/'.join(items)
-            if not _name.startswith(args.path):
-                break
-            if _name in SUM:
-                SUM[_name] += _size
-            else:
-                SUM[_name] = _size
-            items.pop()
+    print("found %d files, %s bytes" % (tree.root.files, tree.root.size))
+    if stats is not None:
+        show_objects(stats, args.human)
 
-    view = [(v, k) for k, v in SUM.items()]
-    view.sort()
-    for v, k in view:
-        print("%s  %s" % (show(v, args.human), k))
 
-    print("found %d files, %s bytes" % (files, size))
+def show_objects(stats, human=False):
+    print("size distribution:")
+    for power in sorted(stats.buckets):
+        _files, _size = stats.buckets[power]
+        print("  <= %s %10d  %s" % (show(2 ** power, True), _files,
+                                    show(_size, human)))
+    if stats.largest:
+        print("largest objects:")
+        for _size, container, name in sorted(stats.largest, reverse=True):
+            print("%s  %s/%s" % (show(_size, human),
+                                 '/'.join(container.split('%2F')), name))
 
 
 if __name__ == "__main__":
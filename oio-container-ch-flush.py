@@ -18,12 +18,14 @@ from __future__ import print_function
 import argparse
 import math
 import os
+import random
 import threading
 import eventlet
 from eventlet import Queue
 import sys
 import time
 from oio.api.object_storage import ObjectStorageApi
+from oio_metrics import Metrics
 
 eventlet.monkey_patch()
 
@@ -32,40 +34,191 @@ ACCOUNT = None
 PROXY = None
 VERBOSE = False
 TIMEOUT = 5
-COUNTERS = None
-ELECTIONS = None
-
-
-class AtomicInteger():
-    def __init__(self):
-        self._files = 0
-        self._size = 0
-        self._lock = threading.Lock()
-        self._total_files = 0
-        self._total_size = 0
-        self._start = time.time()
-
-    def add(self, files, size):
-        with self._lock:
-            self._files += files
-            self._size += size
-
-            self._total_files += files
-            self._total_size += size
-
-    def reset(self):
-        with self._lock:
-            val = (self._files, self._size)
-            self._files = 0
-            self._size = 0
-            return val
-
-    def total(self):
-        with self._lock:
-            return (self._total_files, self._total_size)
-
-    def time(self):
-        return time.time() - self._start
+BATCH_SIZE = 1000
+METRICS = None
+CONTROLLER = None
+LISTING = False
+JOURNAL = None
+
+# Exponential backoff after an election failure, the cap is the default
+# election wait delay of the meta2 services
+MIN_BACKOFF = 0.5
+MAX_BACKOFF = 20.0
+# Adaptive concurrency: requests allowed in flight at startup, weight of
+# the last latency in the moving average, samples before the average is
+# trusted, tolerated latency compared to the best average observed, and
+# factor applied on congestion
+INITIAL_LIMIT = 4
+LATENCY_WEIGHT = 0.2
+LATENCY_WARMUP = 10
+LATENCY_TOLERANCE = 2.0
+DECREASE_FACTOR = 0.5
+
+
+class Controller(object):
+    """
+    Bound the requests in flight, and tune the bound AIMD style: it grows
+    by one per window of requests served under the target latency, and is
+    halved when the latency goes over the target or an election fails.
+    Without an explicit target, the target is a multiple of the best
+    moving average of the latency.
+    """
+
+    def __init__(self, maximum, target=None, initial=INITIAL_LIMIT):
+        self.maximum = maximum
+        self.target = target
+        self.limit = float(min(initial, maximum))
+        self.inflight = 0
+        self.latency = None
+        self.baseline = None
+        self.samples = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.inflight >= int(self.limit):
+                self._cond.wait()
+            self.inflight += 1
+        return time.time()
+
+    def release(self, start, congested=None):
+        """
+        Give back the slot taken at `start`. `congested` tells if the
+        request failed for lack of resources (True), succeeded (False), or
+        failed in a way that does not tell anything about the load (None).
+        """
+        latency = time.time() - start
+        with self._cond:
+            self.inflight -= 1
+            if congested is False:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += LATENCY_WEIGHT * (latency - self.latency)
+                self.samples += 1
+                if self.samples >= LATENCY_WARMUP and (
+                        self.baseline is None or self.latency < self.baseline):
+                    self.baseline = self.latency
+                target = self.target_latency()
+                congested = bool(target) and self.latency > target
+            if congested:
+                self._decrease()
+            elif congested is False:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def _decrease(self):
+        # Once per round trip, the requests already in flight were sent
+        # before the previous decrease
+        now = time.time()
+        if now - self._last_decrease < (self.latency or 0.0):
+            return
+        self._last_decrease = now
+        self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+
+    def target_latency(self):
+        if self.target:
+            return self.target
+        return (self.baseline or 0.0) * LATENCY_TOLERANCE
+
+    def state(self):
+        return "inflight: %d/%d latency: %.1fms target: %.1fms" % (
+            self.inflight, int(self.limit), (self.latency or 0.0) * 1000,
+            self.target_latency() * 1000)
+
+
+class FlushJournal(object):
+    """
+    Append-only record of the progress of a flush, one tab-separated entry
+    per line: the containers queued, the listing marker of each path after
+    each page, the paths completely listed, and the containers deleted or
+    failed. The last entry about a container wins.
+    """
+
+    def __init__(self, path, resume=False):
+        self.queued = set()
+        self.done = set()
+        self.failed = dict()
+        self.markers = dict()
+        self.complete = set()
+        if resume and os.path.exists(path):
+            end = self._load(path)
+            # Drop the line torn by a crash, the next entries would be
+            # appended to it
+            with open(path, 'r+') as journal:
+                journal.truncate(end)
+        self._file = open(path, 'a' if resume else 'w')
+
+    # Fields of each kind of entry
+    FIELDS = {'queued': 2, 'marker': 3, 'complete': 2, 'done': 2,
+              'failed': 3}
+
+    def _load(self, path):
+        """Load the journal, return the offset of its last complete line."""
+        end = 0
+        with open(path, 'rb') as journal:
+            for line in journal:
+                if not line.endswith(b'\n'):
+                    # torn by a crash
+                    break
+                end += len(line)
+                fields = line.decode('utf-8').rstrip('\n').split('\t')
+                kind = fields[0]
+                if len(fields) < self.FIELDS.get(kind, 2):
+                    continue
+                name = fields[1]
+                if kind == 'queued':
+                    self.queued.add(name)
+                elif kind == 'marker':
+                    self.markers[name] = fields[2]
+                elif kind == 'complete':
+                    self.complete.add(name)
+                elif kind == 'done':
+                    self.done.add(name)
+                    self.failed.pop(name, None)
+                elif kind == 'failed':
+                    self.failed[name] = fields[2]
+        return end
+
+    def pending(self):
+        """Containers queued by a previous run, neither done nor failed."""
+        return self.queued - self.done - set(self.failed)
+
+    def _append(self, *fields):
+        self._file.write('\t'.join(fields) + '\n')
+        self._file.flush()
+
+    def record_queued(self, name):
+        self.queued.add(name)
+        self._append('queued', name)
+
+    def record_marker(self, prefix, marker):
+        self.markers[prefix] = marker
+        self._append('marker', prefix, marker)
+
+    def record_complete(self, prefix):
+        self.complete.add(prefix)
+        self._append('complete', prefix)
+
+    def record_done(self, name):
+        self.done.add(name)
+        self.failed.pop(name, None)
+        self._append('done', name)
+
+    def record_failed(self, name, reason):
+        reason = ' '.join(str(reason).split())
+        self.failed[name] = reason
+        self._append('failed', name, reason)
+
+    def close(self):
+        self._file.close()
+
+
+def backoff(attempt):
+    """Exponential backoff with jitter, the delay before retry `attempt`."""
+    delay = min(MAX_BACKOFF, MIN_BACKOFF * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
 
 
 def show(size, human=False):
@@ -82,63 +235,114 @@ def show(size, human=False):
     return "%7s%s" % (s, size_name[i])
 
 
-def worker_objects():
-    proxy = ObjectStorageApi(NS)
+def with_elections(stats, op, func, *args, **kwargs):
+    """
+    Call func within the concurrency bound, again and again while the
+    election of the base fails. The latency of each attempt is recorded
+    in `stats` under `op`.
+    """
+    attempt = 0
     while True:
+        start = CONTROLLER.acquire()
         try:
-            name = QUEUE.get(timeout=TIMEOUT)
-        except eventlet.queue.Empty:
-            if VERBOSE:
-                print("Leaving worker")
+            result = func(*args, **kwargs)
+        except Exception as ex:
+            stats.observe(op, time.time() - start)
+            if "Election failed" not in str(ex):
+                CONTROLLER.release(start)
+                raise
+            CONTROLLER.release(start, congested=True)
+            stats.add('elections_failed')
+            time.sleep(backoff(attempt))
+            attempt += 1
+            continue
+        stats.observe(op, time.time() - start)
+        CONTROLLER.release(start, congested=False)
+        return result
+
+
+def list_page(proxy, stats, name, marker=None):
+    return with_elections(stats, 'object_list', proxy.object_list,
+                          ACCOUNT, name, marker=marker, limit=BATCH_SIZE)
+
+
+def flush_container(proxy, stats, name):
+    """
+    Delete all the objects of a container, page after page. The next page
+    is listed while the current one is being deleted.
+    """
+    page = list_page(proxy, stats, name)
+    while True:
+        objects = page.get('objects') or []
+        prefetch = None
+        if objects and page.get('truncated', len(objects) >= BATCH_SIZE):
+            marker = page.get('next_marker') or objects[-1]['name']
+            prefetch = eventlet.spawn(list_page, proxy, stats, name, marker)
+        try:
+            if objects:
+                if VERBOSE:
+                    print("Deleting", len(objects), "objects")
+                with_elections(stats, 'object_delete_many',
+                               proxy.object_delete_many, ACCOUNT, name,
+                               objs=[_item['name'] for _item in objects])
+                stats.add('objects_deleted', len(objects))
+                stats.add('bytes_deleted',
+                          sum(_item['size'] for _item in objects))
+        except Exception:
+            if prefetch is not None:
+                prefetch.kill()
+            raise
+        if prefetch is None:
             break
+        page = prefetch.wait()
 
-        while True:
-            try:
-                items = proxy.object_list(ACCOUNT, name)
-                objs = [_item['name'] for _item in items['objects']]
-                size = sum([_item['size'] for _item in items['objects']])
-                if len(objs) == 0:
-                    break
-                if VERBOSE:
-                    print("Deleting", len(objs), "objects")
-                proxy.object_delete_many(ACCOUNT, name, objs=objs)
-                COUNTERS.add(len(objs), size)
-                break
-            except Exception as ex:
-                if "Election failed" in str(ex):
-                    # wait default Election wait delay
-                    ELECTIONS.add(1, 0)
-                    time.sleep(20)
-                    continue
-                print("Objs %s: %s" % (name, str(ex)), file=sys.stderr)
-                break
 
-        QUEUE.task_done()
+def delete_container(proxy, stats, name):
+    if VERBOSE:
+        print("Deleting", name)
+    with_elections(stats, 'container_delete', proxy.container_delete,
+                   ACCOUNT, name)
+    stats.add('containers_deleted')
 
 
-def worker_container():
+def worker():
+    """
+    Run the tasks of the queue: empty a container then queue its
+    deletion, or delete an empty container. Leave once the listing is over
+    and the queue stays empty for TIMEOUT seconds.
+    """
     proxy = ObjectStorageApi(NS)
+    stats = METRICS.worker()
     while True:
         try:
-            name = QUEUE.get(timeout=TIMEOUT)
+            task, name = QUEUE.get(timeout=TIMEOUT)
         except eventlet.queue.Empty:
+            if LISTING:
+                continue
+            if VERBOSE:
+                print("Leaving worker")
             break
 
-        while True:
-            if VERBOSE:
-                print("Deleting", name)
+        if task == 'objects':
             try:
-                proxy.container_delete(ACCOUNT, name)
-                COUNTERS.add(1, 0)
-                break
+                flush_container(proxy, stats, name)
+                QUEUE.put(('container', name))
             except Exception as ex:
-                if "Election failed" in str(ex):
-                    # wait default Election wait delay
-                    ELECTIONS.add(1, 0)
-                    time.sleep(20)
-                    continue
-                print("Container %s: %s" % (name, str(ex)), file=sys.stderr)
-                break
+                print("Objs %s: %s" % (name, str(ex)), file=sys.stderr)
+                stats.add('containers_failed')
+                if JOURNAL is not None:
+                    JOURNAL.record_failed(name, ex)
+        else:
+            try:
+                delete_container(proxy, stats, name)
+                if JOURNAL is not None:
+                    JOURNAL.record_done(name)
+            except Exception as ex:
+                print("Container %s: %s" % (name, str(ex)),
+                      file=sys.stderr)
+                stats.add('containers_failed')
+                if JOURNAL is not None:
+                    JOURNAL.record_failed(name, ex)
 
         QUEUE.task_done()
 
@@ -154,140 +358,200 @@ def options():
     parser = argparse.ArgumentParser()
     parser.add_argument("--account", default=os.getenv("OIO_ACCOUNT", "demo"))
     parser.add_argument("--namespace", default=os.getenv("OIO_NS", "OPENIO"))
-    parser.add_argument("--max-worker", default=20, type=int)
+    parser.add_argument("--max-worker", default=100, type=int,
+                        help="Upper bound of the requests in flight, the "
+                             "actual number is tuned from the latency")
+    parser.add_argument("--target-latency", default=0, type=float,
+                        help="Latency in seconds above which the requests "
+                             "in flight are reduced (default: %.0f times "
+                             "the lowest moving average of the latency, "
+                             "once %d requests are served)" % (
+                                 LATENCY_TOLERANCE, LATENCY_WARMUP))
     parser.add_argument("--verbose", default=False, action="store_true")
     parser.add_argument("--timeout", default=5, type=int)
+    parser.add_argument("--batch-size", default=BATCH_SIZE, type=int,
+                        help="Objects listed and deleted per request")
     parser.add_argument("--report", default=60, type=int,
                         help="Report progress every X seconds")
-    parser.add_argument("path", nargs='+', help="bucket/path1/path2")
-
-    return parser.parse_args()
-
-
-def full_list(**kwargs):
-        listing = PROXY.container_list(
-            ACCOUNT, **kwargs)
-        for element in listing:
-            yield element
-
-        while listing:
-            kwargs['marker'] = listing[-1][0]
-            listing = PROXY.container_list(
-                ACCOUNT, **kwargs)
-            if listing:
-                for element in listing:
-                    yield element
+    parser.add_argument("--metrics-textfile",
+                        help="Write the metrics to this Prometheus "
+                             "textfile at each report")
+    parser.add_argument("--metrics-json",
+                        help="Append a JSON snapshot of the metrics to "
+                             "this file at each report")
+    parser.add_argument("--journal",
+                        help="Record the progress of the flush in this file")
+    parser.add_argument("--resume", default=False, action="store_true",
+                        help="Resume the flush recorded in the journal")
+    parser.add_argument("--retry-failed", default=False, action="store_true",
+                        help="Only flush again the containers that failed "
+                             "in the journal")
+    parser.add_argument("path", nargs='*', help="bucket/path1/path2")
+
+    args = parser.parse_args()
+    if (args.resume or args.retry_failed) and not args.journal:
+        parser.error("--resume and --retry-failed need a --journal")
+    if not args.path and not args.retry_failed:
+        parser.error("at least one path is required")
+    return args
+
+
+def list_pages(stats, **kwargs):
+    while True:
+        start = time.time()
+        listing = PROXY.container_list(ACCOUNT, **kwargs)
+        stats.observe('container_list', time.time() - start)
+        if not listing:
+            break
+        yield listing
+        kwargs['marker'] = listing[-1][0]
+
+
+def list_containers(paths, journal=None):
+    """
+    Queue the containers of all the paths, the ones holding objects to be
+    emptied first, the others to be deleted right away. With a journal,
+    the listing of each path restarts from its last marker, and the
+    containers already queued are skipped.
+    """
+    global LISTING
+    stats = METRICS.worker()
+    try:
+        for path in paths:
+            path = path.rstrip('/')
+            if '/' in path:
+                bucket, path = path.split('/', 1)
+            else:
+                bucket = path
+                path = ""
+
+            count = 0
+            _bucket = container_hierarchy(bucket, path)
+            kwargs = {'prefix': _bucket}
+            if journal is not None:
+                if _bucket in journal.complete:
+                    print("Already listed", _bucket)
+                    continue
+                if _bucket in journal.markers:
+                    kwargs['marker'] = journal.markers[_bucket]
+            # we don't use placeholders, we use prefix path as prefix
+            for listing in list_pages(stats, **kwargs):
+                for entry in listing:
+                    name, _files, _size, _ = entry
+                    if (name != _bucket and
+                            not name.startswith(_bucket + '%2F')):
+                        continue
+                    if journal is not None:
+                        if name in journal.queued:
+                            continue
+                        journal.record_queued(name)
+
+                    QUEUE.put(('objects' if _files else 'container', name))
+                    count += 1
+                if journal is not None:
+                    journal.record_marker(_bucket, listing[-1][0])
+            if journal is not None:
+                journal.record_complete(_bucket)
+            print("Listed", count, "containers of", _bucket)
+    finally:
+        LISTING = False
 
 
 def main():
     args = options()
 
-    global ACCOUNT, PROXY, QUEUE, NS, VERBOSE, TIMEOUT
-    global COUNTERS, ELECTIONS
+    global ACCOUNT, PROXY, QUEUE, NS, VERBOSE, TIMEOUT, BATCH_SIZE
+    global METRICS, CONTROLLER, LISTING, JOURNAL
     ACCOUNT = args.account
     NS = args.namespace
     VERBOSE = args.verbose
     TIMEOUT = args.timeout
+    BATCH_SIZE = args.batch_size
     PROXY = ObjectStorageApi(NS)
-    ELECTIONS = AtomicInteger()
 
     num_worker_threads = int(args.max_worker)
-    print("Using %d workers" % num_worker_threads)
-
-    total_objects = {'size': 0,
-                     'files': 0,
-                     'elapsed': 0}
-    total_containers = {'size': 0,
-                        'files': 0,
-                        'elapsed': 0}
-
-    for path in args.path:
-        path = path.rstrip('/')
-        if '/' in path:
-            bucket, path = path.split('/', 1)
+    CONTROLLER = Controller(num_worker_threads, target=args.target_latency)
+    METRICS = Metrics('oio_flush_')
+    METRICS.describe('objects_deleted_total', "Objects deleted")
+    METRICS.describe('bytes_deleted_total', "Size of the objects deleted")
+    METRICS.describe('containers_deleted_total', "Containers deleted")
+    METRICS.describe('containers_failed_total',
+                     "Containers that could not be flushed")
+    METRICS.describe('elections_failed_total',
+                     "Requests that failed with 'Election failed'")
+    METRICS.describe('request_duration_seconds', "Latency of the requests")
+    METRICS.gauge('inflight', lambda: CONTROLLER.inflight,
+                  "Requests in flight")
+    METRICS.gauge('inflight_limit', lambda: int(CONTROLLER.limit),
+                  "Bound of the requests in flight")
+    print("Using up to %d workers" % num_worker_threads)
+
+    # Containers are listed, emptied and deleted at the same time, a
+    # container is deleted as soon as its objects are gone
+    QUEUE = Queue()
+    LISTING = True
+    paths = args.path
+    if args.journal:
+        JOURNAL = FlushJournal(args.journal,
+                               resume=args.resume or args.retry_failed)
+        if args.retry_failed:
+            retry = sorted(JOURNAL.failed)
+            paths = []
         else:
-            bucket = path
-            path = ""
-
-        containers = []
-
-        QUEUE = Queue()
-        pool = eventlet.GreenPool(num_worker_threads)
-
-        for i in range(num_worker_threads):
-            pool.spawn(worker_objects)
-
-        COUNTERS = AtomicInteger()
-        _bucket = container_hierarchy(bucket, path)
-        # we don't use placeholders, we use prefix path as prefix
-        for entry in full_list(prefix=container_hierarchy(bucket, path)):
-            name, _files, _size, _ = entry
-            if name != _bucket and not name.startswith(_bucket + '%2F'):
-                continue
-
-            if _files:
-                QUEUE.put(name)
-
-            containers.append(name)
-
-        # we have to wait all objects
-        print("Waiting flush of objects")
-
-        report = args.report
-
-        while not QUEUE.empty():
-            ts = time.time()
-            while time.time() - ts < report and not QUEUE.empty():
-                time.sleep(1)
-            diff = time.time() - ts
-            val = COUNTERS.reset()
-            elections = ELECTIONS.reset()
-            print("Objects: %5.2f / Size: %5.2f" % (
-                  val[0] / diff, val[1] / diff),
-                  "Elections failed: %5.2f/s total: %d" % (
-                  elections[0] / diff, ELECTIONS.total()[0]
-                  ), " " * 20,
-                  end='\r')
-            sys.stdout.flush()
-
-        print("Waiting end of workers")
-        QUEUE.join()
-
-        val = COUNTERS.total()
-        total_objects['files'] += val[0]
-        total_objects['size'] += val[1]
-        total_objects['elapsed'] += COUNTERS.time()
-
-        COUNTERS = AtomicInteger()
-
-        QUEUE = Queue()
-        for i in range(num_worker_threads):
-            pool.spawn(worker_container)
-
-        print("We have to delete", len(containers), "containers")
-
-        for container in containers:
-            QUEUE.put(container)
-
-        while not QUEUE.empty():
-            ts = time.time()
-            while time.time() - ts < report and not QUEUE.empty():
-                time.sleep(1)
-            diff = time.time() - ts
-            val = COUNTERS.reset()
-            elections = ELECTIONS.reset()
-            print("Containers: %5.2f" % (val[0] / diff),
-                  "Elections failed: %5.2f/s total: %d" % (
-                  elections[0] / diff, ELECTIONS.total()[0]
-                  ), " " * 20,
-            end='\r')
-            sys.stdout.flush()
-
-        QUEUE.join()
-        val = COUNTERS.total()
-        total_containers['files'] += val[0]
-        total_containers['size'] += val[1]
-        total_containers['elapsed'] += COUNTERS.time()
+            retry = sorted(JOURNAL.pending())
+        if retry:
+            print("Retrying", len(retry), "containers from the journal")
+        for name in retry:
+            QUEUE.put(('objects', name))
+    pool = eventlet.GreenPool(num_worker_threads)
+    for i in range(num_worker_threads):
+        pool.spawn(worker)
+    lister = eventlet.spawn(list_containers, paths, JOURNAL)
+
+    def done():
+        return lister.dead and QUEUE.unfinished_tasks == 0
+
+    def export(snapshot):
+        if args.metrics_textfile:
+            METRICS.write_textfile(args.metrics_textfile, snapshot)
+        if args.metrics_json:
+            METRICS.append_json(args.metrics_json, snapshot)
+
+    report = args.report
+    previous = None
+    while not done():
+        ts = time.time()
+        while time.time() - ts < report and not done():
+            time.sleep(1)
+        snapshot = METRICS.snapshot()
+        rates = METRICS.rates(snapshot, previous)
+        previous = snapshot
+        export(snapshot)
+        print("Objects: %5.2f / Size: %5.2f" % (
+              rates.get('objects_deleted', 0), rates.get('bytes_deleted', 0)),
+              "Containers: %5.2f" % rates.get('containers_deleted', 0),
+              "Elections failed: %5.2f/s total: %d" % (
+              rates.get('elections_failed', 0),
+              snapshot['counters'].get('elections_failed', 0)
+              ), CONTROLLER.state(), " " * 20,
+              end='\r')
+        sys.stdout.flush()
+
+    print("Waiting end of workers")
+    lister.wait()
+    QUEUE.join()
+    pool.waitall()
+    if JOURNAL is not None:
+        JOURNAL.close()
+
+    snapshot = METRICS.snapshot()
+    export(snapshot)
+    counters = snapshot['counters']
+    total_objects = {'files': counters.get('objects_deleted', 0),
+                     'size': counters.get('bytes_deleted', 0),
+                     'elapsed': snapshot['elapsed']}
+    total_containers = {'files': counters.get('containers_deleted', 0),
+                        'elapsed': snapshot['elapsed']}
 
     print("""
 Objects:
@@ -307,7 +571,11 @@ Containers:
 """.format(o=total_containers,
            o_file_avg=total_containers['files']/total_containers['elapsed']))
 
-    print("Elections failed: %d" % ELECTIONS.total()[0])
+    print("Elections failed: %d" % counters.get('elections_failed', 0))
+    for op, histogram in sorted(snapshot['histograms'].items()):
+        print("%s: %d requests, p50 < %gs, p99 < %gs" % (
+              op, histogram.count, histogram.percentile(50),
+              histogram.percentile(99)))
 
 if __name__ == "__main__":
     main()
@@ -1,28 +1,81 @@
 #!/usr/bin/env python
 
-from os import makedirs
-from os.path import dirname, exists
+from os import makedirs, remove
+from os.path import commonprefix, dirname, exists, realpath
 from sqlite3 import connect
 from itertools import product
-from sys import stderr
+from sys import exit, stderr
+from time import time
 import logging
 
 from oio.common.utils import cid_from_name
+from oio_fastclone import clone_file
 
 
 hexa = "0123456789abcdef"
 nb_xdigits = 2
 flag_prune = False
 flag_vacuum = False
+split_engine = 'route'
+nb_jobs = 1
+# The keys of a plan, instead of all the prefixes of nb_xdigits: a
+# prefix, or a range of prefixes of the same length such as '3a-41'
+plan = None
+# The autocontainer rules naming the shards, instead of the prefixes
+rules = None
+# Rows buffered per shard and per table before being inserted
+batch_size = 1000
+# Shards a process builds at once, in a scan of the source per group
+# of them (default: as many as the limit of open files allows)
+max_open_shards = None
+# Files kept for the source, the logs and the pool, out of that limit
+RESERVED_FILES = 64
+# What the source is scanned for, each row coming with its alias, and
+# the column to restrict to a range of aliases
+ROUTED_TABLES = (
+    ('aliases', "SELECT alias, * FROM aliases", 'alias'),
+    ('contents', "SELECT a.alias, c.* FROM aliases a "
+                 "JOIN contents c ON c.id = a.content", 'a.alias'),
+    ('chunks', "SELECT a.alias, c.* FROM aliases a "
+               "JOIN chunks c ON c.content = a.content", 'a.alias'),
+    ('properties', "SELECT alias, * FROM properties", 'alias'),
+)
 
 
 def prefixes():
+    if plan is not None:
+        for key in plan:
+            yield key
+        return
     plop = list()
     for i in range(nb_xdigits):
         plop.append(hexa)
     for prefix in product(*plop):
         yield ''.join(prefix)
 
+
+def key_bounds(key):
+    """The first and the last prefixes of a key of a plan."""
+    bounds = key.split('-')
+    return bounds[0], bounds[-1]
+
+
+def key_prefixes(key):
+    """The prefixes a key of a plan covers: itself, or a range of them."""
+    low, high = key_bounds(key)
+    if low == high:
+        return [low]
+    return ['%0*x' % (len(low), value)
+            for value in range(int(low, 16), int(high, 16) + 1)]
+
+
+def range_key(low, high):
+    """The key of the prefixes from low to high, as short as it gets."""
+    while len(low) > 1 and low[-1] == '0' and high[-1] == 'f':
+        low, high = low[:-1], high[:-1]
+    return low if low == high else low + '-' + high
+
+
 def whois(db):
     uname, aname = None, None
     for row in db.execute("SELECT v FROM admin WHERE k = 'sys.user.name'"):
@@ -32,56 +85,641 @@ def whois(db):
     return aname, uname
 
 
-def compute_new_cname(acct, cname, prefix):
-    return acct, ''.join([cname, prefix])
+def compute_new_cname(acct, cname, key):
+    if rules is not None:
+        # The rules give the whole name
+        return acct, key
+    return acct, ''.join([cname, key])
+
+
+def reset_admin(tnx, cname, cid):
+    tnx.execute("UPDATE admin SET v = ? WHERE k = 'sys.user.name'", (cname, ))
+    tnx.execute("UPDATE admin SET v = ? WHERE k = 'sys.name'", (cid + '.1', ))
 
 
-def prune_database(db, cname, cid, prefix):
+def update_stats(tnx):
+    tnx.execute("UPDATE admin SET v = 0 WHERE k = 'sys.status'")
+    tnx.execute("DELETE FROM admin WHERE k = 'sys.peers'")
+    tnx.execute("UPDATE admin SET v = (SELECT COUNT(*) FROM aliases) WHERE k = 'sys.m2.objects'")
+    tnx.execute("UPDATE admin SET v = (SELECT SUM(c.size) FROM contents c, aliases a WHERE c.id = a.content) WHERE k = 'sys.m2.usage'")
+
+
+def shard_stats(db):
+    stats = dict(db.execute("SELECT k, v FROM admin WHERE k IN "
+                            "('sys.m2.objects', 'sys.m2.usage')"))
+    return (int(stats.get('sys.m2.objects') or 0),
+            int(stats.get('sys.m2.usage') or 0))
+
+
+def prune_database(db, cname, cid, key, route):
     db.execute("PRAGMA journal_mode = MEMORY")
     db.execute("PRAGMA foreign_keys = FALSE")
     db.execute("PRAGMA synchronous = OFF")
     tnx = db.cursor()
-    tnx.execute("UPDATE admin SET v = ? WHERE k = 'sys.user.name'", (cname, ))
-    tnx.execute("UPDATE admin SET v = ? WHERE k = 'sys.name'", (cid + '.1', ))
+    reset_admin(tnx, cname, cid)
     if flag_prune:
+        db.create_function('shard_of', 1, route)
         tnx.execute("DELETE FROM aliases "
-                    "WHERE alias NOT LIKE 'cloud_images/{0}%'".format(prefix))
+                    "WHERE shard_of(alias) IS NOT ?", (key, ))
         tnx.execute("DELETE FROM contents "
                     "WHERE id NOT IN (SELECT DISTINCT content FROM aliases)")
         tnx.execute("DELETE FROM properties "
                     "WHERE alias NOT IN (SELECT alias FROM aliases)")
         tnx.execute("DELETE FROM chunks "
                     "WHERE content NOT IN (SELECT id FROM contents)")
-    tnx.execute("UPDATE admin SET v = 0 WHERE k = 'sys.status'")
-    tnx.execute("DELETE FROM admin WHERE k = 'sys.peers'")
-    tnx.execute("UPDATE admin SET v = (SELECT COUNT(*) FROM aliases) WHERE k = 'sys.m2.objects'")
-    tnx.execute("UPDATE admin SET v = (SELECT SUM(c.size) FROM contents c, aliases a WHERE c.id = a.content) WHERE k = 'sys.m2.usage'")
+    update_stats(tnx)
     db.commit()
     if flag_vacuum:
         db.execute("VACUUM")
 
-def sharded_container(basedir, acct, cname, path, as_prefix=""):
-    for prefix in prefixes():
-        new_acct, new_cname = compute_new_cname(acct, cname, prefix)
-        new_cid = cid_from_name(new_acct, new_cname)
-        new_path = basedir + '/' + new_cid[0:3] + '/' + new_cid + '.1.meta2'
-        logging.debug("%s %s %s %s", new_path, new_acct, new_cname, new_cid)
 
+def shard_path(basedir, acct, cname, prefix):
+    new_acct, new_cname = compute_new_cname(acct, cname, prefix)
+    new_cid = cid_from_name(new_acct, new_cname)
+    new_path = basedir + '/' + new_cid[0:3] + '/' + new_cid + '.1.meta2'
+    logging.debug("%s %s %s %s", new_path, new_acct, new_cname, new_cid)
+
+    try:
+        makedirs(dirname(new_path))
+    except OSError:
+        pass
+    return new_acct, new_cname, new_cid, new_path
+
+
+def alias_head(cname, as_prefix):
+    """Where the aliases of the container start: '<name>/<as_prefix>'."""
+    return cname[:len(cname) - len(as_prefix)] + '/' + as_prefix
+
+
+def case_variants(digits):
+    """The digits, with their letters in every case."""
+    variants = ['']
+    for char in digits:
+        variants = [variant + case for variant in variants
+                    for case in sorted(set((char, char.upper())))]
+    return variants
+
+
+def alias_ranges(cname, as_prefix, shard_prefixes):
+    """
+    The ranges of the aliases of consecutive shards, end excluded. The
+    digits are routed whatever their case, and the upper case letters
+    sort apart from the lower case ones: there is a range per case of
+    the digits the shards share, and of the next one.
+    """
+    head = alias_head(cname, as_prefix)
+    first = key_bounds(shard_prefixes[0])[0]
+    last = key_bounds(shard_prefixes[-1])[1]
+    common = commonprefix([first, last])
+    ranges = list()
+    for variant in case_variants(common):
+        if first == last:
+            ranges.append((head + variant, head + variant[:-1] +
+                           chr(ord(variant[-1]) + 1)))
+            continue
+        low, high = first[len(common)], last[len(common)]
+        ranges.append((head + variant + low,
+                       head + variant + chr(ord(high) + 1)))
+        if low not in hexa[:10]:
+            # The upper case letters sort after the digits, so they are
+            # in the range above when it starts with a digit
+            ranges.append((head + variant + low.upper(),
+                           head + variant + chr(ord(high.upper()) + 1)))
+    return ranges
+
+
+def prefix_router(cname, as_prefix):
+    """
+    Route an alias to the shard of the digits following its prefix,
+    whatever their case, as LIKE did.
+    """
+    head = alias_head(cname, as_prefix)
+    start = len(head)
+    known = dict((prefix, key) for key in prefixes()
+                 for prefix in key_prefixes(key))
+    lengths = sorted(set(len(prefix) for prefix in known))
+
+    def route(alias):
+        if alias.startswith(head):
+            # The prefixes of a plan have various lengths, none of them
+            # being the start of another
+            for length in lengths:
+                key = known.get(alias[start:start + length].lower())
+                if key is not None:
+                    return key
+        return None
+    return route
+
+
+def rules_router():
+    """Route an alias to the container the autocontainer rules name."""
+    from oio.common.autocontainer import NoMatchFound, RegexContainerBuilder
+    builder = RegexContainerBuilder(rules)
+
+    def route(alias):
         try:
-            makedirs(dirname(new_path))
-        except OSError:
-            pass
+            return builder(alias)
+        except NoMatchFound:
+            return None
+    return route
+
+
+def make_router(cname, as_prefix):
+    if rules is not None:
+        return rules_router()
+    return prefix_router(cname, as_prefix)
+
+
+def route_batches(cursor, route):
+    """
+    Yield the rows of the cursor with the key of their alias, first
+    column of the rows. The rows are fetched by batches, and the key of
+    each alias is computed once per batch.
+    """
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        keys = dict((alias, route(alias))
+                    for alias in set(row[0] for row in rows))
+        for row in rows:
+            yield keys[row[0]], row
+
+
+def shard_keys(path, route):
+    """
+    The shards to build: the prefixes, or the names the rules give.
+    Return them with the count of the aliases routed to none of them.
+    """
+    keys = dict()
+    db = connect(path)
+    try:
+        for key, _ in route_batches(
+                db.execute("SELECT alias FROM aliases"), route):
+            keys[key] = keys.get(key, 0) + 1
+    finally:
+        db.close()
+    unrouted = keys.pop(None, 0)
+    if rules is None:
+        return list(prefixes()), unrouted
+    return sorted(keys), unrouted
+
+
+def check_target(path, new_path):
+    if exists(new_path) and realpath(new_path) == realpath(path):
+        raise Exception("The shard would replace the container")
+
+
+def discard_shard(path, new_path):
+    """Remove what a failed run left of a shard, never the container."""
+    if exists(new_path) and realpath(new_path) != realpath(path):
+        remove(new_path)
+
+
+def open_shards_limit():
+    """Shards that can be open at once, each of them holding a file."""
+    if max_open_shards:
+        return max_open_shards
+    import resource
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return 4096
+    return max(1, soft - RESERVED_FILES)
+
+
+def shard_groups(keys):
+    """Consecutive keys, in groups of about the same size."""
+    groups = (len(keys) + open_shards_limit() - 1) // open_shards_limit()
+    step = (len(keys) + groups - 1) // groups
+    return [keys[i:i + step] for i in range(0, len(keys), step)]
+
+
+class ShardBase(object):
+    """
+    A shard built from scratch: the schema and the admin table of the
+    source, then the rows routed to it, inserted by batches within a
+    single transaction.
+    """
+
+    def __init__(self, src, path, cname, cid):
+        if exists(path):
+            remove(path)
+        self.db = connect(path)
+        for pragma in ('page_size', 'auto_vacuum'):
+            value = src.execute("PRAGMA %s" % pragma).fetchone()[0]
+            self.db.execute("PRAGMA %s = %d" % (pragma, value))
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.deferred = list()
+        for kind, sql in src.execute(
+                "SELECT type, sql FROM sqlite_master "
+                "WHERE sql NOT NULL AND name NOT LIKE 'sqlite_%' "
+                "ORDER BY type = 'table' DESC"):
+            if kind == 'table':
+                self.db.execute(sql)
+            else:
+                # Faster to build once the rows are in
+                self.deferred.append(sql)
+        self.db.executemany("INSERT INTO admin VALUES (?, ?)",
+                            src.execute("SELECT k, v FROM admin"))
+        reset_admin(self.db, cname, cid)
+        self.buffers = dict()
+        self.rows = 0
+        self.path = path
+
+    def add(self, table, row):
+        rows = self.buffers.setdefault(table, list())
+        rows.append(row)
+        if len(rows) >= batch_size:
+            self.flush(table)
+
+    def flush(self, table):
+        rows = self.buffers.pop(table, None)
+        if rows:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO %s VALUES (%s)" % (
+                    table, ','.join('?' * len(rows[0]))), rows)
+            self.rows += len(rows)
+
+    def close(self):
+        for table in list(self.buffers):
+            self.flush(table)
+        for sql in self.deferred:
+            self.db.execute(sql)
+        update_stats(self.db)
+        self.db.commit()
+        stats = shard_stats(self.db)
+        self.db.close()
+        return stats
+
+    def abort(self):
+        self.db.close()
+        remove(self.path)
+
+
+def routed_group(src, basedir, acct, cname, path, keys, route, bounds):
+    """
+    Build some shards in a single scan of the source: each row of the
+    aliases, contents, chunks and properties goes to the shard its alias
+    is routed to. The rows of no shard are left out.
+
+    The time of a shard runs from the creation of its base, through the
+    scan it shares with the group, to its commit.
+    """
+    results = list()
+    shards = dict()
+    start = time()
+    started = dict()
+    try:
+        for key in keys:
+            new_acct, new_cname, new_cid, new_path = shard_path(
+                basedir, acct, cname, key)
+            check_target(path, new_path)
+            started[key] = time()
+            shards[key] = (new_acct, new_cname, new_cid, ShardBase(
+                src, new_path, new_cname, new_cid))
+        for table, query, column in ROUTED_TABLES:
+            if bounds:
+                query += " WHERE {0} >= ? AND {0} < ?".format(column)
+            for bound in bounds or [()]:
+                for key, row in route_batches(
+                        src.execute(query, bound), route):
+                    shard = shards.get(key)
+                    if shard is not None:
+                        shard[3].add(table, row[1:])
+        for key in keys:
+            new_acct, new_cname, new_cid, shard = shards.pop(key)
+            objects, usage = shard.close()
+            results.append((new_acct, new_cname, new_cid,
+                            objects, usage, time() - started[key], None))
+    except Exception as e:
+        from traceback import print_exc
+        print_exc(file=stderr)
+        for shard in shards.values():
+            shard[3].abort()
+        for key in keys[len(results):]:
+            new_acct, new_cname, new_cid = shard_path(
+                basedir, acct, cname, key)[:3]
+            results.append((new_acct, new_cname, new_cid, 0, 0,
+                            time() - started.get(key, start), str(e)))
+    return results
+
+
+def routed_container(basedir, acct, cname, path, keys, route, as_prefix,
+                     ranged=False):
+    """
+    Build the shards with a scan of the source per group of them, as
+    many as can be open at once.
+
+    When only some of the shards are built by a scan, only their range
+    of aliases is read, unless the rules name the shards. Through the
+    index, a row costs about twice as much as in a full scan.
+    """
+    results = list()
+    groups = shard_groups(keys)
+    ranged = rules is None and (ranged or len(groups) > 1)
+    src = connect(path)
+    try:
+        for group in groups:
+            bounds = alias_ranges(cname, as_prefix, group) \
+                if ranged else None
+            results.extend(routed_group(src, basedir, acct, cname, path,
+                                        group, route, bounds))
+    finally:
+        src.close()
+    return results
+
+
+def copied_container(basedir, acct, cname, path, keys, route):
+    """Build the shards one after the other, each from a full copy."""
+    results = list()
+    for key in keys:
+        start = time()
+        new_acct, new_cname, new_cid, new_path = shard_path(
+            basedir, acct, cname, key)
 
         try:
-            from subprocess import check_call
-            check_call(["/bin/cp", "-p", path, new_path])
+            check_target(path, new_path)
+            clone_file(path, new_path)
             with connect(new_path) as db:
-                prune_database(db, new_cname, new_cid,
-                               ''.join([as_prefix, prefix]))
-            print new_acct, new_cname, new_cid
-        except Exception:
+                prune_database(db, new_cname, new_cid, key, route)
+                objects, usage = shard_stats(db)
+            results.append((new_acct, new_cname, new_cid,
+                            objects, usage, time() - start, None))
+        except Exception as e:
             from traceback import print_exc
             print_exc(file=stderr)
+            results.append((new_acct, new_cname, new_cid,
+                            0, 0, time() - start, str(e)))
+    return results
+
+
+def build_shards(job):
+    """
+    Entry point of the workers, each owning some shards, and compiling
+    its own router.
+    """
+    basedir, acct, cname, path, keys, as_prefix, ranged = job
+    route = make_router(cname, as_prefix)
+    if flag_prune and split_engine == 'route':
+        return routed_container(basedir, acct, cname, path, keys, route,
+                                as_prefix, ranged=ranged)
+    return copied_container(basedir, acct, cname, path, keys, route)
+
+
+def alias_digits(alias, start, depth):
+    """The hexadecimal digits of the alias, up to depth, in lower case."""
+    digits = alias[start:start + depth].lower()
+    for i, char in enumerate(digits):
+        if char not in hexa:
+            return digits[:i]
+    return digits
+
+
+def alias_histogram(path, cname, as_prefix, depth):
+    """
+    Objects and bytes by prefix of the aliases, with up to `depth`
+    hexadecimal digits, from a single scan of the base.
+    Return the sums of each length of prefix, and the totals of the
+    aliases out of '<name>/<as_prefix>'.
+    """
+    head = alias_head(cname, as_prefix)
+    start = len(head)
+    leaves = dict()
+    other = [0, 0]
+    db = connect(path)
+    try:
+        for alias, size in db.execute(
+                "SELECT a.alias, c.size FROM aliases a "
+                "LEFT JOIN contents c ON c.id = a.content"):
+            if not alias.startswith(head):
+                other[0] += 1
+                other[1] += size or 0
+                continue
+            key = alias_digits(alias, start, depth)
+            counts = leaves.get(key)
+            if counts is None:
+                counts = leaves[key] = [0, 0]
+            counts[0] += 1
+            counts[1] += size or 0
+    finally:
+        db.close()
+    sums = [dict() for _ in range(depth + 1)]
+    for key, (objects, usage) in leaves.items():
+        for length in range(len(key) + 1):
+            counts = sums[length].setdefault(key[:length], [0, 0])
+            counts[0] += objects
+            counts[1] += usage
+    return sums, other
+
+
+def prefix_weight(sums, prefix):
+    if len(prefix) >= len(sums):
+        return [0, 0]
+    return sums[len(prefix)].get(prefix, [0, 0])
+
+
+def key_weight(sums, key):
+    loads = [prefix_weight(sums, prefix) for prefix in key_prefixes(key)]
+    return [sum(load[i] for load in loads) for i in (0, 1)]
+
+
+def partition(loads, cap):
+    """
+    Cut the loads, in their order, in runs weighing no more than cap,
+    unless a single load does. Return where each run ends.
+    """
+    ends, run = list(), 0
+    for index, load in enumerate(loads):
+        if run and run + load > cap:
+            ends.append(index)
+            run = 0
+        run += load
+    ends.append(len(loads))
+    return ends
+
+
+def balanced_prefixes(sums, weight, shards=None, size=None):
+    """
+    The keys of a plan: ranges of consecutive prefixes as long as the
+    depth of the histogram, with the lowest largest load for `shards`
+    of them, or as few as loaded at most with `size`.
+    """
+    depth = len(sums) - 1
+    leaves = sorted(sums[depth].items())
+    loads = [load[weight] for _, load in leaves]
+    if not loads:
+        return [range_key('0' * depth, 'f' * depth)]
+
+    def lowest_cap(count):
+        low, high = max(loads), sum(loads)
+        while low < high:
+            cap = (low + high) // 2
+            if len(partition(loads, cap)) <= count:
+                high = cap
+            else:
+                low = cap + 1
+        return low
+
+    if size is not None:
+        shards = len(partition(loads, max(size, max(loads))))
+    ends = partition(loads, lowest_cap(shards))
+    runs = list(zip([0] + ends[:-1], ends))
+    # Closer to the count of shards, without a heavier one
+    while len(runs) < shards:
+        splittable = [run for run in runs if run[1] - run[0] > 1]
+        if not splittable:
+            break
+        start, end = max(splittable,
+                         key=lambda run: sum(loads[run[0]:run[1]]))
+        half, middle = sum(loads[start:end]) / 2.0, start + 1
+        while middle < end - 1 and sum(loads[start:middle]) < half:
+            middle += 1
+        index = runs.index((start, end))
+        runs[index:index + 1] = [(start, middle), (middle, end)]
+    keys, low = list(), 0
+    for _, end in runs[:-1]:
+        # The prefixes with no load go with the range before them
+        high = int(leaves[end][0], 16)
+        keys.append(range_key('%0*x' % (depth, low),
+                              '%0*x' % (depth, high - 1)))
+        low = high
+    keys.append(range_key('%0*x' % (depth, low), 'f' * depth))
+    return keys
+
+
+def print_plan(sums, other, prefixes_, weight):
+    """The plan, as read by --from-plan: one key per line."""
+    loads = [key_weight(sums, key) for key in prefixes_]
+    total = prefix_weight(sums, '')
+    print "# %-10s %10s %14s" % ("prefix", "objects", "bytes")
+    for prefix, (objects, usage) in zip(prefixes_, loads):
+        print "%-12s %10d %14d" % (prefix, objects, usage)
+    values = [load[weight] for load in loads]
+    mean = float(sum(values)) / len(values)
+    skew = max(values) / mean if mean else 0.0
+    print "# %d shards, largest %d, smallest %d, mean %.0f, skew %.2f" % (
+        len(values), max(values), min(values), mean, skew)
+    if nb_xdigits < len(sums):
+        fixed = [load[weight] for load in sums[nb_xdigits].values()]
+        fixed += [0] * (len(hexa) ** nb_xdigits - len(fixed))
+        mean = float(sum(fixed)) / len(fixed)
+        fixed_skew = max(fixed) / mean if mean else 0.0
+        print "# %d shards on %d digits, largest %d, smallest %d, " \
+            "skew %.2f" % (len(fixed), nb_xdigits, max(fixed), min(fixed),
+                           fixed_skew)
+        if skew > fixed_skew:
+            logging.warning("The plan is more skewed than the split on %d "
+                            "digits (%.2f against %.2f)", nb_xdigits, skew,
+                            fixed_skew)
+    lost = [total[i] - sum(load[i] for load in loads) for i in (0, 1)]
+    print "# left out: %d objects, %d bytes out of the prefix, " \
+        "%d objects, %d bytes not routed to any shard" % (
+            other[0], other[1], lost[0], lost[1])
+
+
+def load_plan(path):
+    """Read the keys of a plan, and check they cover all the aliases."""
+    keys = list()
+    with open(path) as plan_file:
+        for line in plan_file:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                keys.append(line.split()[0].lower())
+    if not keys:
+        raise Exception("Empty plan")
+    for key in keys:
+        bounds = key.split('-')
+        if len(bounds) > 2 or len(set(len(bound) for bound in bounds)) > 1 \
+                or any(not bound or any(char not in hexa for char in bound)
+                       for bound in bounds) \
+                or bounds[0] > bounds[-1]:
+            raise Exception("Plan key %s is not a prefix or a range of "
+                            "prefixes" % key)
+    # Where the keys start and end, among the prefixes of the longest
+    depth = max(len(key_bounds(key)[0]) for key in keys)
+    spans = list()
+    for key in keys:
+        low, high = key_bounds(key)
+        scale = 16 ** (depth - len(low))
+        spans.append((int(low, 16) * scale, (int(high, 16) + 1) * scale,
+                      key))
+    spans.sort()
+    end = 0
+    for start, stop, key in spans:
+        if start < end:
+            raise Exception("Plan key %s overlaps another one" % key)
+        if start > end:
+            raise Exception("Plan does not cover all the hexadecimal "
+                            "prefixes")
+        end = stop
+    if end != 16 ** depth:
+        raise Exception("Plan does not cover all the hexadecimal prefixes")
+    return [key for _, _, key in spans]
+
+
+def report(results, elapsed, unrouted=0):
+    failed = 0
+    stderr.write("%-32s %10s %14s %9s  %s\n" % (
+        "cname", "objects", "bytes", "seconds", "status"))
+    for new_acct, new_cname, new_cid, objects, usage, seconds, error in \
+            results:
+        if error:
+            failed += 1
+        stderr.write("%-32s %10d %14d %9.1f  %s\n" % (
+            new_cname, objects, usage, seconds, error or "ok"))
+    stderr.write("%d shards, %d failed, %d objects, %d bytes in %.1fs, "
+                 "%d aliases left out\n" % (
+                     len(results), failed, sum(r[3] for r in results),
+                     sum(r[4] for r in results), elapsed, unrouted))
+    return failed
+
+
+def sharded_container(basedir, acct, cname, path, as_prefix=""):
+    """
+    Build the shards of the container, with nb_jobs processes owning
+    consecutive shards each. Return the count of failed shards.
+
+    The shards are only printed when all of them have been built: a
+    failed run removes every shard it built.
+    """
+    start = time()
+    keys, unrouted = shard_keys(path, make_router(cname, as_prefix))
+    if not keys:
+        raise Exception("No alias routed to any shard")
+    if not flag_prune:
+        # Every shard keeps all the aliases
+        unrouted = 0
+    elif unrouted:
+        logging.warning("%d aliases are routed to no shard, and will be "
+                        "left out of all of them", unrouted)
+    jobs = max(1, min(nb_jobs, len(keys)))
+    step = (len(keys) + jobs - 1) // jobs
+    # Consecutive prefixes cover a range of aliases, not the names of the
+    # rules
+    ranged = jobs > 1 and rules is None
+    work = [(basedir, acct, cname, path, keys[i:i + step], as_prefix, ranged)
+            for i in range(0, len(keys), step)]
+    results = list()
+    if jobs == 1:
+        outputs = map(build_shards, work)
+    else:
+        from multiprocessing import Pool
+        pool = Pool(jobs)
+        outputs = pool.map(build_shards, work, 1)
+        pool.close()
+        pool.join()
+    for output in outputs:
+        results.extend(output)
+    failed = report(results, time() - start, unrouted)
+    if failed:
+        for key in keys:
+            discard_shard(path, shard_path(basedir, acct, cname, key)[3])
+        stderr.write("Removed the %d shards of the failed run\n" % len(keys))
+        return failed
+    for result in results:
+        print result[0], result[1], result[2]
+    return failed
 
 
 def main():
@@ -94,6 +732,55 @@ def main():
     parser.add_argument('--prune', dest='prune',
                         default=False, action='store_true',
                         help='Remove contents')
+    parser.add_argument('--engine', dest='engine',
+                        choices=('route', 'copy'), default='route',
+                        help='With --prune, build the shards in a single '
+                             'scan of the container (route), or copy the '
+                             'whole container once per shard then prune '
+                             'each copy (copy)')
+    parser.add_argument('--batch-size', dest='batch_size',
+                        type=int, default=1000,
+                        help='Rows inserted at once in a shard')
+    parser.add_argument('--jobs', '-j', dest='jobs',
+                        type=int, default=1,
+                        help='Build the shards in that many processes')
+    parser.add_argument('--open-shards', dest='open_shards',
+                        type=int, default=None,
+                        help='Shards a process builds at once with --engine '
+                             'route, scanning the container once per group '
+                             'of them (default: as many as the limit of '
+                             'open files allows)')
+    parser.add_argument('--plan', dest='plan',
+                        default=False, action='store_true',
+                        help='Print a plan of ranges of prefixes balancing '
+                             'the shards, to be split with --from-plan')
+    parser.add_argument('--plan-shards', dest='plan_shards',
+                        type=int, default=None,
+                        help='Shards the plan aims at (default: as many as '
+                             'with --digits)')
+    parser.add_argument('--plan-size', dest='plan_size',
+                        type=int, default=None,
+                        help='Largest shard of the plan, in objects or bytes')
+    parser.add_argument('--plan-weight', dest='plan_weight',
+                        choices=('objects', 'bytes'), default='bytes',
+                        help='What the plan balances')
+    parser.add_argument('--plan-depth', dest='plan_depth',
+                        type=int, default=4,
+                        help='Length of the prefixes the ranges of the '
+                             'plan are made of')
+    parser.add_argument('--from-plan', dest='from_plan',
+                        type=str, default=None,
+                        help='Split on the prefixes of a plan instead '
+                             'of --digits')
+    parser.add_argument('--rule', dest='rules',
+                        type=str, action='append', default=None,
+                        help='Name the shards with this autocontainer rule, '
+                             'as the clients do, instead of the prefixes '
+                             '(may be repeated, the first matching wins)')
+    parser.add_argument('--rules', dest='rules_file',
+                        type=str, default=None,
+                        help='Read the autocontainer rules from a file, '
+                             'one per line')
     parser.add_argument('--vacuum', dest='vacuum',
                         default=False, action='store_true',
                         help='VACUUM the DB file for dirty pages')
@@ -116,10 +803,30 @@ def main():
     global flag_prune
     global nb_xdigits
     global nb_as_xdigits
+    global split_engine
+    global batch_size
+    global nb_jobs
+    global max_open_shards
+    global plan
+    global rules
     flag_vacuum = args.vacuum
     flag_prune = args.prune
     nb_xdigits = args.xdigits
     nb_as_xdigits = args.already_sharded_xdigits
+    split_engine = args.engine
+    batch_size = args.batch_size
+    nb_jobs = args.jobs
+    max_open_shards = args.open_shards
+    if args.from_plan:
+        plan = load_plan(args.from_plan)
+    rules = args.rules
+    if args.rules_file:
+        with open(args.rules_file) as rules_file:
+            rules = (rules or []) + [
+                line.rstrip('\r\n') for line in rules_file
+                if line.strip() and not line.startswith('#')]
+    if rules is not None and (args.plan or args.from_plan):
+        parser.error("The plans are made of prefixes, not of rules")
     # Configure the logging
     if args.verbose:
         logging.basicConfig(
@@ -146,16 +853,26 @@ def main():
         raise Exception("Container unknown")
     cid = cid_from_name(acct, cname)
     logging.debug("%s %s %s %s", path, acct, cname, cid)
-    if cname.find('cloud_images') > 0:
-        raise Exception("Container is not 'cloud_images'")
 
     if nb_as_xdigits == 0:
-        sharded_container(basedir, acct, cname, path)
-        return
+        as_pre = ""
     else:
         as_pre = cname[-nb_as_xdigits:]
         logging.debug("%s %s %s %s", path, acct, cname, cid)
-        sharded_container(basedir, acct, cname, path, as_prefix=as_pre)
+
+    if args.plan:
+        weight = ('objects', 'bytes').index(args.plan_weight)
+        sums, other = alias_histogram(path, cname, as_pre,
+                                      args.plan_depth)
+        shards = args.plan_shards
+        if shards is None and args.plan_size is None:
+            shards = len(hexa) ** nb_xdigits
+        print_plan(sums, other, balanced_prefixes(
+            sums, weight, shards=shards, size=args.plan_size), weight)
+        return
+    failed = sharded_container(basedir, acct, cname, path, as_prefix=as_pre)
+    if failed:
+        exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 OpenIO SAS, as part of OpenIO SDS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark the checks of oio-meta2-auditor on synthetic meta2 bases.
+
+The bases are generated once in the work directory, and reused by the
+next runs. Timings are taken with a warm page cache, the best of
+--repeat runs is kept.
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import sqlite3
+import struct
+import sys
+import time
+try:
+    from importlib.machinery import SourceFileLoader
+    from importlib.util import module_from_spec, spec_from_loader
+except ImportError:  # Python 2
+    import imp
+    SourceFileLoader = None
+
+
+META2_SCHEMA = """
+CREATE TABLE IF NOT EXISTS admin (
+ k TEXT PRIMARY KEY NOT NULL,
+ v BLOB DEFAULT NULL);
+CREATE TABLE IF NOT EXISTS aliases (
+ alias TEXT NOT NULL,
+ version INT NOT NULL,
+ content BLOB NOT NULL,
+ deleted BOOL NOT NULL,
+ ctime INT NOT NULL,
+ mtime INT NOT NULL,
+ PRIMARY KEY (alias, version));
+CREATE TABLE IF NOT EXISTS properties (
+ alias TEXT NOT NULL,
+ version INT NOT NULL,
+ key TEXT NOT NULL,
+ value BLOB DEFAULT NULL,
+ PRIMARY KEY (alias, version, key));
+CREATE TABLE IF NOT EXISTS contents (
+ id BLOB NOT NULL PRIMARY KEY,
+ hash BLOB DEFAULT NULL,
+ size INT NOT NULL,
+ ctime INT NOT NULL,
+ mime_type TEXT NOT NULL,
+ chunk_method TEXT NOT NULL,
+ policy TEXT DEFAULT NULL);
+CREATE TABLE IF NOT EXISTS chunks (
+ id TEXT NOT NULL,
+ content BLOB NOT NULL,
+ position TEXT NOT NULL,
+ hash BLOB NOT NULL,
+ size INT NOT NULL,
+ ctime INT NOT NULL,
+ PRIMARY KEY (content, position, id));
+CREATE INDEX IF NOT EXISTS alias_content ON aliases(content);
+"""
+CHUNKS_PER_CONTENT = 3
+BATCH = 10000
+
+
+def load_source(name, path):
+    """Load a script as a module, whatever its extension."""
+    if SourceFileLoader is None:
+        return imp.load_source(name, path)
+    loader = SourceFileLoader(name, path)
+    module = module_from_spec(spec_from_loader(name, loader))
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def load_auditor():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'oio-meta2-auditor')
+    return load_source('oio_meta2_auditor', path)
+
+
+def content_id(i):
+    # Spread the identifiers the way hashes would
+    return sqlite3.Binary(struct.pack(
+        '>QQ', (i * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF, i))
+
+
+def generate(path, rows, flags):
+    """Build a meta2 base with `rows` contents, each with an alias."""
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode = OFF")
+    db.execute("PRAGMA synchronous = OFF")
+    db.executescript(META2_SCHEMA)
+    db.executemany("INSERT INTO admin (k, v) VALUES (?, ?)",
+                   [(flag, '1') for flag in flags])
+    for start in range(0, rows, BATCH):
+        ids = range(start, min(start + BATCH, rows))
+        db.executemany(
+            "INSERT INTO contents VALUES (?, NULL, ?, 0, 'octet/stream',"
+            " 'ec/algo=liberasurecode_rs_vand,k=6,m=3', NULL)",
+            ((content_id(i), i % 65536) for i in ids))
+        db.executemany(
+            "INSERT INTO aliases VALUES (?, 1, ?, 0, 0, 0)",
+            (("obj/%08x/%d" % (i * 2654435761 % (1 << 32), i),
+              content_id(i)) for i in ids))
+        db.executemany(
+            "INSERT INTO chunks VALUES (?, ?, ?, '', 0, 0)",
+            (("http://127.0.0.1:6200/%032X%d" % (i, pos),
+              content_id(i), str(pos))
+             for i in ids for pos in range(CHUNKS_PER_CONTENT)))
+        db.commit()
+    db.close()
+
+
+def best_of(repeat, func, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def legacy_orphans(path, auditor):
+    conn = sqlite3.connect(path)
+    try:
+        for req in auditor.JOIN_REQS:
+            conn.execute(req).fetchone()
+    finally:
+        conn.close()
+
+
+def current_orphans(path, auditor):
+    conn = sqlite3.connect(path)
+    try:
+        list(auditor.count_orphans(conn))
+    finally:
+        conn.close()
+
+
+def plain_integrity(path, auditor):
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA integrity_check").fetchall()
+    finally:
+        conn.close()
+
+
+def readonly_integrity(path, auditor):
+    conn = auditor.open_readonly(path)
+    try:
+        conn.execute("PRAGMA integrity_check").fetchall()
+    finally:
+        conn.close()
+
+
+def bench_base(args, auditor, rows):
+    path = os.path.join(args.workdir, 'bench-%d.meta2' % rows)
+    if not os.path.exists(path):
+        generate(path, rows, auditor.MANDATORY_FLAGS)
+    return path
+
+
+def bench_orphans(args, auditor):
+    print("%10s %12s %12s %8s" % ("rows", "JOIN_REQS", "orphans", "speedup"))
+    for rows in args.rows:
+        path = bench_base(args, auditor, rows)
+        legacy = best_of(args.repeat, legacy_orphans, path, auditor)
+        current = best_of(args.repeat, current_orphans, path, auditor)
+        print("%10d %11.3fs %11.3fs %7.2fx" % (
+              rows, legacy, current, legacy / current))
+        sys.stdout.flush()
+
+
+def bench_open(args, auditor):
+    print("%10s %10s %14s %14s %8s" % (
+          "rows", "MiB", "plain MiB/s", "ro+mmap MiB/s", "speedup"))
+    for rows in args.rows:
+        path = bench_base(args, auditor, rows)
+        size = os.path.getsize(path) / (1024.0 * 1024.0)
+        plain = best_of(args.repeat, plain_integrity, path, auditor)
+        readonly = best_of(args.repeat, readonly_integrity, path, auditor)
+        print("%10d %10.1f %14.1f %14.1f %7.2fx" % (
+              rows, size, size / plain, size / readonly, plain / readonly))
+        sys.stdout.flush()
+
+
+def options():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--workdir', default='/tmp/oio-meta2-bench',
+                        help="Where the synthetic bases are kept")
+    parser.add_argument('--rows', default='10000,1000000,10000000',
+                        type=lambda x: [int(r) for r in x.split(',')],
+                        help="Comma-separated sizes of the bases, "
+                             "in contents (default: %(default)s)")
+    parser.add_argument('--repeat', default=3, type=int,
+                        help="Runs of each check, the best is kept")
+    parser.add_argument('check', choices=('orphans', 'open'),
+                        help="The check to benchmark")
+    return parser.parse_args()
+
+
+def main():
+    args = options()
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    auditor = load_auditor()
+    if args.check == 'orphans':
+        bench_orphans(args, auditor)
+    elif args.check == 'open':
+        bench_open(args, auditor)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# Copyright (C) 2019 OpenIO SAS, as part of OpenIO SDS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Copy the bases as fast as their filesystem allows.
+
+A reflink (FICLONE) shares the extents of the source on btrfs and XFS,
+whatever the size of the base. Otherwise the copy stays in the kernel
+with copy_file_range() or sendfile(), and falls back to a copy through
+a buffer. The copy gets the mode, the owner and the times of the source,
+and is synced to the disk.
+"""
+
+import errno
+import fcntl
+import os
+import shutil
+
+
+# _IOW(0x94, 9, int), from linux/fs.h
+FICLONE = 0x40049409
+# Largest request to copy_file_range() and sendfile()
+CHUNK_SIZE = 1 << 30
+BUFFER_SIZE = 1024 * 1024
+# What a method not supported by the kernel, the filesystem or the pair
+# of files fails with
+UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+               errno.ENOSYS, errno.EBADF, errno.ETXTBSY)
+
+
+def _reflink(src_fd, dst_fd, size):
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def _copy_file_range(src_fd, dst_fd, size):
+    copied = 0
+    while copied < size:
+        done = os.copy_file_range(src_fd, dst_fd,
+                                  min(CHUNK_SIZE, size - copied))
+        if not done:
+            break
+        copied += done
+
+
+def _sendfile(src_fd, dst_fd, size):
+    copied = 0
+    while copied < size:
+        done = os.sendfile(dst_fd, src_fd, copied,
+                           min(CHUNK_SIZE, size - copied))
+        if not done:
+            break
+        copied += done
+
+
+def _buffered(src_fd, dst_fd, size):
+    while True:
+        data = os.read(src_fd, BUFFER_SIZE)
+        if not data:
+            break
+        while data:
+            data = data[os.write(dst_fd, data):]
+
+
+METHODS = [('reflink', _reflink)]
+if hasattr(os, 'copy_file_range'):
+    METHODS.append(('copy_file_range', _copy_file_range))
+if hasattr(os, 'sendfile'):
+    METHODS.append(('sendfile', _sendfile))
+METHODS.append(('buffered', _buffered))
+
+
+def _copy(src_fd, dst_fd, methods):
+    candidates = [(name, method) for name, method in METHODS
+                  if name in methods]
+    if not candidates:
+        raise ValueError("No copy method in %s" % methods)
+    size = os.fstat(src_fd).st_size
+    for name, method in candidates:
+        try:
+            method(src_fd, dst_fd, size)
+            return name
+        except (IOError, OSError) as err:
+            if err.errno not in UNSUPPORTED or name == candidates[-1][0]:
+                raise
+            # Start over with the next method
+            os.ftruncate(dst_fd, 0)
+            os.lseek(src_fd, 0, os.SEEK_SET)
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+
+
+def clone_file(src, dst, methods=None):
+    """
+    Replace `dst` with a copy of `src`, with the first method of
+    `methods` (default: all of them, fastest first) that the files
+    support. Return the name of the method used.
+    """
+    methods = methods or [name for name, _ in METHODS]
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            name = _copy(src_fd, dst_fd, methods)
+            st = os.fstat(src_fd)
+            try:
+                os.fchown(dst_fd, st.st_uid, st.st_gid)
+            except OSError:
+                pass
+            shutil.copystat(src, dst)
+            os.fsync(dst_fd)
+        except Exception:
+            os.close(dst_fd)
+            os.remove(dst)
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    return name
@@ -0,0 +1,203 @@
+# Copyright (C) 2019 OpenIO SAS, as part of OpenIO SDS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Counters and latency histograms for the long-running tools.
+
+Each worker updates its own WorkerMetrics without any lock, Metrics sums
+them when a snapshot is taken. Snapshots can be written as a Prometheus
+textfile (for the node exporter textfile collector) or appended as JSON
+lines.
+"""
+
+from __future__ import print_function
+import bisect
+import json
+import os
+import time
+
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _finite(value):
+    return None if value == float('inf') else value
+
+
+class Histogram(object):
+    """Fixed buckets, the last one counts the values above the bounds."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def percentile(self, pct):
+        """Upper bound of the bucket holding the percentile."""
+        rank = self.count * pct / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else \
+                    float('inf')
+        return 0.0
+
+
+class WorkerMetrics(object):
+    """The metrics of a single worker, never shared."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counters = dict()
+        self.histograms = dict()
+
+    def add(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, op, value):
+        histogram = self.histograms.get(op)
+        if histogram is None:
+            histogram = self.histograms[op] = Histogram(self.bounds)
+        histogram.observe(value)
+
+
+class Metrics(object):
+    """
+    Registry of the workers of a tool. `prefix` is prepended to the
+    names of the exported metrics.
+    """
+
+    def __init__(self, prefix, bounds=LATENCY_BUCKETS):
+        self.prefix = prefix
+        self.bounds = bounds
+        self.start = time.time()
+        self.workers = list()
+        self.gauges = dict()
+        self.help = dict()
+
+    def worker(self):
+        worker = WorkerMetrics(self.bounds)
+        self.workers.append(worker)
+        return worker
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def gauge(self, name, func, text=None):
+        """Export the value returned by func when a snapshot is taken."""
+        self.gauges[name] = func
+        if text:
+            self.describe(name, text)
+
+    def snapshot(self):
+        counters = dict()
+        histograms = dict()
+        for worker in list(self.workers):
+            for name, value in list(worker.counters.items()):
+                counters[name] = counters.get(name, 0) + value
+            for op, histogram in list(worker.histograms.items()):
+                merged = histograms.get(op)
+                if merged is None:
+                    merged = histograms[op] = Histogram(self.bounds)
+                merged.merge(histogram)
+        now = time.time()
+        return {'time': now,
+                'elapsed': now - self.start,
+                'counters': counters,
+                'gauges': dict((name, func())
+                               for name, func in self.gauges.items()),
+                'histograms': histograms}
+
+    @staticmethod
+    def rates(current, previous):
+        """Per-second rate of each counter between two snapshots."""
+        elapsed = current['time'] - previous['time'] if previous \
+            else current['elapsed']
+        elapsed = elapsed or 1e-9
+        before = previous['counters'] if previous else dict()
+        return dict((name, (value - before.get(name, 0)) / elapsed)
+                    for name, value in current['counters'].items())
+
+    def _header(self, lines, name, kind):
+        if name in self.help:
+            lines.append("# HELP %s%s %s" % (self.prefix, name,
+                                             self.help[name]))
+        lines.append("# TYPE %s%s %s" % (self.prefix, name, kind))
+
+    def prometheus(self, snapshot, histogram_name='request_duration_seconds'):
+        """Render a snapshot in the Prometheus text exposition format."""
+        lines = list()
+        # The counters described are exported before their first increment
+        counters = dict((name[:-len('_total')], 0) for name in self.help
+                        if name.endswith('_total'))
+        counters.update(snapshot['counters'])
+        for name, value in sorted(counters.items()):
+            self._header(lines, name + '_total', 'counter')
+            lines.append("%s%s_total %s" % (self.prefix, name, value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            self._header(lines, name, 'gauge')
+            lines.append("%s%s %s" % (self.prefix, name, value))
+        if snapshot['histograms']:
+            self._header(lines, histogram_name, 'histogram')
+        metric = self.prefix + histogram_name
+        for op, histogram in sorted(snapshot['histograms'].items()):
+            seen = 0
+            for i, count in enumerate(histogram.counts):
+                seen += count
+                bound = '%g' % histogram.bounds[i] \
+                    if i < len(histogram.bounds) else '+Inf'
+                lines.append('%s_bucket{op="%s",le="%s"} %d' % (
+                    metric, op, bound, seen))
+            lines.append('%s_sum{op="%s"} %f' % (metric, op, histogram.sum))
+            lines.append('%s_count{op="%s"} %d' % (
+                metric, op, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path, snapshot):
+        """Replace the textfile atomically, the collector may read it."""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as out:
+            out.write(self.prometheus(snapshot))
+        os.rename(tmp, path)
+
+    def append_json(self, path, snapshot):
+        record = {
+            'time': snapshot['time'],
+            'elapsed': snapshot['elapsed'],
+            'counters': snapshot['counters'],
+            'gauges': snapshot['gauges'],
+            'latency': dict(
+                (op, {'count': h.count, 'sum': h.sum,
+                      'p50': _finite(h.percentile(50)),
+                      'p99': _finite(h.percentile(99))})
+                for op, h in snapshot['histograms'].items()),
+        }
+        with open(path, 'a') as out:
+            out.write(json.dumps(record, sort_keys=True) + '\n')